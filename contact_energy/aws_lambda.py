@@ -1,9 +1,7 @@
 import json
 import logging
 import subprocess
-import time
 import uuid
-from random import uniform
 
 from requests import Session
 
@@ -15,12 +13,13 @@ with open("contact_energy/header_csrf_token.json") as f:
     header_csrf_token = json.load(f)
 with open("contact_energy/request_usage.ps1") as f:
     req_usage = f.read()
-sess = Session()
-sess.trust_env = False
 
 
 class ContactEnergyUsage:
     def __init__(self, username, password):
+        # In server mode, users log in concurrently, so they cannot share cookies.
+        sess = Session()
+        sess.trust_env = False
         # Log in, get authentication (session).
         resp_login = sess.post(
             url="https://api.contact-digital-prod.net/login/v2",
@@ -36,10 +35,9 @@ class ContactEnergyUsage:
                             f"Reason: {resp_login.reason}")
 
         # Get CSRF key and contract ID.
-        header_csrf_token["session"] = self.auth
         resp_csrf_token = sess.get(
             url="https://api.contact-digital-prod.net/accounts/v2?ba=",
-            headers=header_csrf_token,
+            headers={**header_csrf_token, "session": self.auth},
         )
         if resp_csrf_token.status_code != 200:
             raise Exception(f"Fail to get CSRF key, account number, and contract number. "
@@ -72,7 +70,6 @@ class ContactEnergyUsage:
         resp_usage = stdout.decode('utf-8')
         try:
             usage = json.loads(resp_usage)
-            time.sleep(round(uniform(0.7, 1.3), 2))
             return usage
         except json.decoder.JSONDecodeError:
             logging.warning(f"The authentication of Contact Energy account expires. "
@@ -0,0 +1,133 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from local_db import get_db_path
+
+
+def create_profile_tables(c):
+    c.execute("create table if not exists profile (meter_id integer, month integer, "
+              "weekday integer, hour integer, total real, count integer, "
+              "primary key (meter_id, month, weekday, hour))")
+    c.execute("create table if not exists profile_state (meter_id integer primary key, "
+              "last_rowid integer, n_rows integer)")
+    c.commit()
+
+
+def update_profile(row_id):
+    """
+    Fold usage rows that are not yet in the seasonal profile of a meter into it.
+    The profile keeps the sum and count of hourly usage per (month, weekday, hour), so
+    only rows appended since the last fit are read. If rows that were already fitted
+    have been deleted, or the state is removed by `save_usage` replacing a day, the
+    profile of this meter is fitted again from scratch.
+    :param row_id: ROWID of the meter in table "meter"
+    :return:
+    """
+    c = sqlite3.connect(get_db_path())
+    exist_table_usage = c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='usage'"
+    ).fetchone()
+    if exist_table_usage is None:
+        c.close()
+        return
+    create_profile_tables(c)
+    # Sessions of the same user may update the profile at the same time, so reading the
+    # state and folding in new rows is one write transaction.
+    c.execute("begin immediate")
+    state = c.execute(
+        "select last_rowid, n_rows from profile_state where meter_id = ?", (row_id,)
+    ).fetchone()
+    last_rowid, n_rows = state if state else (0, 0)
+    n_fitted = c.execute(
+        "select count(*) from usage where meter_id = ? and ROWID <= ?",
+        (row_id, last_rowid)
+    ).fetchone()[0]
+    if state is None or n_fitted != n_rows:
+        c.execute("delete from profile where meter_id = ?", (row_id,))
+        last_rowid, n_rows = 0, 0
+    usage = pd.read_sql_query(
+        sql="select ROWID, year, month, day, hour, value from usage where meter_id = ? "
+            "and ROWID > ?",
+        con=c,
+        params=[row_id, last_rowid],
+    )
+    if usage.shape[0] > 0:
+        usage['weekday'] = pd.to_datetime(usage[['year', 'month', 'day']]).dt.weekday
+        increment = usage.groupby(by=['month', 'weekday', 'hour'])['value'].agg(
+            total='sum', n='count')
+        increment.reset_index(inplace=True)
+        c.executemany(
+            "insert into profile values (?, ?, ?, ?, ?, ?) "
+            "on conflict (meter_id, month, weekday, hour) do update set "
+            "total = total + excluded.total, count = count + excluded.count",
+            [(row_id, int(r.month), int(r.weekday), int(r.hour), float(r.total),
+              int(r.n)) for r in increment.itertuples(index=False)]
+        )
+        last_rowid = int(usage['rowid'].max())
+        n_rows += usage.shape[0]
+    c.execute("insert or replace into profile_state values (?, ?, ?)",
+              (row_id, last_rowid, n_rows))
+    c.commit()
+    c.close()
+
+
+def get_profile(row_id):
+    """
+    Get the seasonal profile of a meter, after folding in the latest usage.
+    :param row_id: ROWID of the meter in table "meter"
+    :return: Table with columns ['month', 'weekday', 'hour', 'value', 'count'] where
+        'value' is the average electricity usage in kWh of that hour of week in that
+        month of year, and 'count' is the number of hours it is averaged from.
+    """
+    update_profile(row_id)
+    c = sqlite3.connect(get_db_path())
+    try:
+        profile = pd.read_sql_query(
+            sql="select month, weekday, hour, total / count as value, count "
+                "from profile where meter_id = ?",
+            con=c,
+            params=[row_id],
+        )
+    except pd.errors.DatabaseError:
+        profile = pd.DataFrame(columns=['month', 'weekday', 'hour', 'value', 'count'])
+    c.close()
+    return profile
+
+
+def project_annual_usage(profile, start_date=None):
+    """
+    Extrapolate 12 months of hourly usage from a seasonal profile.
+    Months of year that have no history fall back to the hour-of-week average over all
+    observed months.
+    :param profile: returned value of `get_profile`
+    :param start_date: First date of the projected 12 months, default today.
+    :return: Hourly electricity usage table, which includes columns of
+        ['year', 'month', 'day', 'hour', 'value']
+        which is the same format as `get_usage`. Empty if the profile is empty.
+    """
+    if profile.shape[0] == 0:
+        return pd.DataFrame(columns=['year', 'month', 'day', 'hour', 'value'])
+    start_date = pd.Timestamp(start_date or pd.Timestamp.today()).normalize()
+    hours = pd.date_range(start=start_date, end=start_date + pd.DateOffset(years=1),
+                          freq='1h', inclusive='left')
+    usage = pd.DataFrame({
+        'year': hours.year,
+        'month': hours.month,
+        'day': hours.day,
+        'hour': hours.hour,
+        'weekday': hours.weekday,
+    })
+    seasonal = profile.set_index(['month', 'weekday', 'hour'])['value']
+    profile_week = profile.assign(total=profile['value'] * profile['count'])
+    profile_week = profile_week.groupby(by=['weekday', 'hour'])[['total', 'count']].sum()
+    weekly = profile_week['total'] / profile_week['count']
+    value = seasonal.reindex(pd.MultiIndex.from_frame(
+        usage[['month', 'weekday', 'hour']])).to_numpy()
+    fallback = weekly.reindex(pd.MultiIndex.from_frame(
+        usage[['weekday', 'hour']])).to_numpy()
+    value = np.where(np.isnan(value), fallback, value)
+    # hours of week that never appear in history
+    usage['value'] = np.nan_to_num(value, nan=np.nanmean(value))
+    return usage[['year', 'month', 'day', 'hour', 'value']]
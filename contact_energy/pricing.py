@@ -1,56 +1,138 @@
 import sqlite3
+from datetime import date
+
 import pandas as pd
 import numpy as np
 
-db_path = "contact_energy.db"
+from local_db import get_db_path
+
 gst_rate = 0.15
+parameters = [
+    'weekend_price',
+    'weekend_fixed',
+    'night_price',
+    'night_fixed',
+    'broadband_price',
+    'broadband_levy',
+    'broadband_fixed',
+    'charge_day_price',
+    'charge_night_price',
+    'charge_fixed',
+    'basic_price',
+    'basic_levy',
+    'basic_fixed',
+]
+# Unit prices saved before versioning apply since Contact Energy is founded.
+earliest_effective_date = "1996-01-01"
+
+
+def create_price_table(c):
+    """
+    Create the table "price", or add the column "effective_date" to the table created by
+    previous versions of this program.
+    :param c: sqlite3 connection
+    :return:
+    """
+    c.execute("create table if not exists price (meter_id INTEGER, name TEXT, "
+              "price REAL, effective_date TEXT)")
+    columns = [row[1] for row in c.execute("pragma table_info(price)")]
+    if 'effective_date' not in columns:
+        c.execute(f"alter table price add column effective_date TEXT not null "
+                  f"default '{earliest_effective_date}'")
+    c.execute("create index if not exists price_meter_date on price "
+              "(meter_id, effective_date)")
+    c.commit()
+
+
+def exist_price_table(c):
+    return c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='price'"
+    ).fetchone() is not None
+
+
+def migrate_price_table():
+    """
+    Add the column "effective_date" to the table "price" created by previous versions of
+    this program. Run once per database before reading unit prices, so reading does not
+    write. Reading a table that is not migrated raises an error.
+    :return:
+    """
+    c = sqlite3.connect(get_db_path())
+    if exist_price_table(c):
+        create_price_table(c)
+    c.close()
 
 
-def get_unit_price(row_id) -> dict:
-    parameters = [
-        'weekend_price',
-        'weekend_fixed',
-        'night_price',
-        'night_fixed',
-        'broadband_price',
-        'broadband_levy',
-        'broadband_fixed',
-        'charge_day_price',
-        'charge_night_price',
-        'charge_fixed',
-        'basic_price',
-        'basic_levy',
-        'basic_fixed',
-    ]
-    c = sqlite3.connect(db_path)
-    try:
+def get_unit_price(row_id, date_=None) -> dict:
+    """
+    Get the unit prices of a meter in force on a date.
+    :param row_id: ROWID of the meter in table "meter"
+    :param date_: str "%Y-%m-%d", default today. If the date is earlier than all
+        versions, the earliest version is returned.
+    :return: Unit price dictionary, values may be NaN
+    """
+    date_ = date_ or date.today().isoformat()
+    c = sqlite3.connect(get_db_path())
+    price = {}
+    if exist_price_table(c):
+        price = dict(c.execute(
+            "select name, price from price where meter_id = ?1 and effective_date = "
+            "coalesce((select max(effective_date) from price where meter_id = ?1 and "
+            "effective_date <= ?2), (select min(effective_date) from price where "
+            "meter_id = ?1))",
+            (row_id, date_)
+        ).fetchall())
+    c.close()
+    return {p: price.get(p, np.nan) for p in parameters}
+
+
+def get_unit_price_versions(row_id):
+    """
+    Get all versions of the unit prices of a meter.
+    :param row_id: ROWID of the meter in table "meter"
+    :return: Table indexed by effective date in ascending order, whose columns are unit
+        price names, values may be NaN
+    """
+    c = sqlite3.connect(get_db_path())
+    price = pd.DataFrame(columns=['effective_date', 'name', 'price'])
+    if exist_price_table(c):
         price = pd.read_sql_query(
-            sql="select name, price from price where meter_id = ?",
+            sql="select effective_date, name, price from price where meter_id = ? "
+                "order by effective_date",
             con=c,
             params=[row_id]
         )
-        price = price.set_index('name')
-        price = price[~price.index.duplicated(keep='first')]
-        price = price.reindex(parameters).to_dict()['price']
-    except pd.errors.DatabaseError:
-        price = {p: np.nan for p in parameters}
     c.close()
+    if price.shape[0] == 0:
+        return pd.DataFrame(np.nan, index=pd.to_datetime([earliest_effective_date]),
+                            columns=parameters)
+    price = price.pivot_table(index='effective_date', columns='name', values='price',
+                              aggfunc='first')
+    price.index = pd.to_datetime(price.index)
+    price = price.reindex(columns=parameters)
     return price
 
 
-def save_unit_price(row_id, **kwargs):
-    c = sqlite3.connect(db_path)
-    exist_table_price = pd.read_sql_query(
-        sql="SELECT name FROM sqlite_master WHERE type='table' AND name='price'",
-        con=c,
+def save_unit_price(row_id, effective_date=None, **kwargs):
+    """
+    Save a version of the unit prices of a meter. The version of the same effective date
+    is replaced, other versions are kept.
+    :param row_id: ROWID of the meter in table "meter"
+    :param effective_date: str "%Y-%m-%d", default today.
+    :param kwargs: Unit prices, NaN or None values are not saved.
+    :return:
+    """
+    effective_date = effective_date or date.today().isoformat()
+    c = sqlite3.connect(get_db_path())
+    create_price_table(c)
+    c.execute("delete from price where meter_id = ? and effective_date = ?",
+              (row_id, effective_date))
+    c.executemany(
+        "insert into price (meter_id, name, price, effective_date) values (?, ?, ?, ?)",
+        [(row_id, k, float(v), effective_date) for k, v in kwargs.items()
+         if v is not None and not np.isnan(v)]
     )
-    if exist_table_price.shape[0] > 0:
-        c.execute("delete from price where meter_id = ?", (row_id,))
-        c.commit()
-    price = pd.DataFrame(list(kwargs.items()), columns=['name', 'price'])
-    price.dropna(inplace=True)
-    price.insert(loc=0, column='meter_id', value=row_id)
-    price.to_sql(name='price', con=c, if_exists='append', index=False)
+    c.commit()
     c.close()
 
 
@@ -60,39 +142,52 @@ def get_total_price(usage, unit_price):
     :param usage: Hourly electricity usage table, which includes columns of
         ['year', 'month', 'day', 'hour', 'value']
         where 'value' is electricity usage in the corresponding hour in unit of kWh
-    :param unit_price: Unit price dictionary, values may be NaN
+    :param unit_price: Unit price dictionary, values may be NaN; or returned value of
+        `get_unit_price_versions`, where each hour and day is priced at the version in
+        force on that date, and dates before the earliest version are priced at it.
     :return:
     """
+    if usage.shape[0] == 0:
+        return {}
+    if isinstance(unit_price, dict):
+        unit_price = pd.DataFrame([unit_price], index=pd.to_datetime(
+            [earliest_effective_date]))
     total_price_excl_gst = {}
-    dates = pd.to_datetime(usage[['year', 'month', 'day']])
-    start_date = dates.min()
-    end_date = dates.max()
-    total_days = round((end_date - start_date) / pd.Timedelta(days=1)) + 1
-
-    usage['date'] = pd.to_datetime(usage[['year', 'month', 'day']])
-    usage['weekend_is_free'] = ((usage['date'].dt.weekday > 4) & (usage['hour'] >= 9) &
-                                (usage['hour'] < 17))
+    dates = pd.DatetimeIndex(pd.to_datetime(usage[['year', 'month', 'day']]))
+    days = pd.date_range(start=dates.min(), end=dates.max(), freq='1d')
+    effective_dates = unit_price.index.to_numpy(dtype='datetime64[ns]')
+    hour_version = np.maximum(np.searchsorted(
+        effective_dates, dates.to_numpy(dtype='datetime64[ns]'), side='right') - 1, 0)
+    day_version = np.maximum(np.searchsorted(
+        effective_dates, days.to_numpy(dtype='datetime64[ns]'), side='right') - 1, 0)
+
+    def hourly(name):
+        return unit_price[name].to_numpy(dtype=float)[hour_version]
+
+    def daily(name):
+        return unit_price[name].to_numpy(dtype=float)[day_version].sum()
+
+    value = np.nan_to_num(usage['value'].to_numpy(dtype=float))
+    hour = usage['hour'].to_numpy()
+    weekend_is_free = (dates.weekday.to_numpy() > 4) & (hour >= 9) & (hour < 17)
     total_price_excl_gst['weekend'] = \
-        (usage.loc[~usage['weekend_is_free'], 'value'].sum() * unit_price['weekend_price']
-         + total_days * unit_price['weekend_fixed'])
-    usage['night_is_free'] = usage['hour'] >= 21
+        (np.where(weekend_is_free, 0, value * hourly('weekend_price')).sum() +
+         daily('weekend_fixed'))
+    night_is_free = hour >= 21
     total_price_excl_gst['night'] = \
-        (usage.loc[~usage['night_is_free'], 'value'].sum() * unit_price['night_price'] +
-         total_days * unit_price['night_fixed'])
+        (np.where(night_is_free, 0, value * hourly('night_price')).sum() +
+         daily('night_fixed'))
     total_price_excl_gst['broadband'] = \
-        (usage['value'].sum() * (
-                unit_price['broadband_price'] + unit_price['broadband_levy']) +
-         total_days * unit_price['broadband_fixed'])
-    usage['charge_is_day'] = (usage['hour'] >= 7) & (usage['hour'] < 21)
+        ((value * (hourly('broadband_price') + hourly('broadband_levy'))).sum() +
+         daily('broadband_fixed'))
+    charge_is_day = (hour >= 7) & (hour < 21)
     total_price_excl_gst['charge'] = \
-        usage['value'].sum() * unit_price['charge_night_price'] + \
-        (usage['value'] * usage['charge_is_day']).sum() * (
-            unit_price['charge_day_price'] - unit_price['charge_night_price']) + \
-        total_days * unit_price['charge_fixed']
+        ((value * np.where(charge_is_day, hourly('charge_day_price'),
+                           hourly('charge_night_price'))).sum() +
+         daily('charge_fixed'))
     total_price_excl_gst['basic'] = \
-        (usage['value'].sum() * (
-                unit_price['basic_price'] + unit_price['basic_levy']) +
-         total_days * unit_price['basic_fixed'])
+        ((value * (hourly('basic_price') + hourly('basic_levy'))).sum() +
+         daily('basic_fixed'))
     # add GST, convert cents to dollars
     total_price = {}
     for k, v in total_price_excl_gst.items():
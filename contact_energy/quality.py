@@ -0,0 +1,209 @@
+import logging
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from local_db import (create_usage_index, get_account_contract_list,
+                      get_db_path)
+
+tz = "Pacific/Auckland"
+# Iglewicz and Hoaglin's threshold of the modified z-score
+spike_threshold = 3.5
+issue_columns = ['date', 'issue', 'detail', 'refetch']
+
+
+def create_issue_table(c):
+    c.execute("create table if not exists usage_issue (meter_id INTEGER, date TEXT, "
+              "issue TEXT, detail TEXT, refetch INTEGER, refetched INTEGER default 0, "
+              "primary key (meter_id, date, issue))")
+    c.commit()
+    create_usage_index(c)
+
+
+def find_issues(usage, daily_total):
+    """
+    Find data-quality issues in hourly usage.
+    :param usage: Hourly electricity usage table of the days to scan, which includes
+        columns of ['year', 'month', 'day', 'hour', 'value']
+    :param daily_total: Daily electricity usage table of all history of the meter, which
+        includes columns of ['year', 'month', 'day', 'value']
+    :return: Table with columns ['date', 'issue', 'detail', 'refetch'] where 'date' is
+        str "%Y-%m-%d", and 'refetch' is 1 if the day should be fetched again.
+    """
+    if usage.shape[0] == 0:
+        return pd.DataFrame(columns=issue_columns)
+    usage = usage.assign(date=pd.to_datetime(usage[['year', 'month', 'day']]))
+    days = usage.groupby(by='date')
+    n_rows = days.size()
+    n_hours = days['hour'].nunique()
+    dates = pd.DatetimeIndex(n_rows.index)
+    # Midnight always exists in New Zealand, so the length of the local day is the
+    # number of hours between two midnights, which is 23 or 25 on DST transition days.
+    expected = ((dates + pd.Timedelta(days=1)).tz_localize(tz) - dates.tz_localize(tz)) \
+        / pd.Timedelta(hours=1)
+    expected = np.asarray(expected, dtype=int)
+    issues = []
+
+    hour_count = (n_hours.to_numpy() != 24) & (n_hours.to_numpy() != expected)
+    issues.append(pd.DataFrame({
+        'date': dates[hour_count],
+        'issue': 'hour_count',
+        'detail': [f"{n} hours, expected {e}" for n, e in
+                   zip(n_hours.to_numpy()[hour_count], expected[hour_count])],
+        'refetch': 1,
+    }))
+
+    n_duplicates = n_rows.to_numpy() - n_hours.to_numpy()
+    duplicate = n_duplicates > np.maximum(expected - 24, 0)
+    issues.append(pd.DataFrame({
+        'date': dates[duplicate],
+        'issue': 'duplicate',
+        'detail': [f"{n} duplicated hours" for n in n_duplicates[duplicate]],
+        'refetch': 1,
+    }))
+
+    stamps = pd.DatetimeIndex(usage['date'] + pd.to_timedelta(
+        usage['hour'].clip(0, 23), unit='h'))
+    nonexistent = stamps.tz_localize(
+        tz, ambiguous=np.zeros(stamps.shape[0], dtype=bool), nonexistent='NaT').isna()
+    dst_shift = usage.loc[nonexistent | (usage['hour'] < 0) | (usage['hour'] > 23)]
+    dst_shift = dst_shift.groupby(by='date')['hour'].agg(
+        lambda x: ', '.join(map(str, x)))
+    issues.append(pd.DataFrame({
+        'date': dst_shift.index,
+        'issue': 'dst_shift',
+        'detail': [f"hour {h} does not exist in local time" for h in dst_shift],
+        'refetch': 0,
+    }))
+
+    extremes = days['value'].agg(['min', 'max'])
+    flatline = extremes['min'] == extremes['max']
+    issues.append(pd.DataFrame({
+        'date': extremes.index[flatline],
+        'issue': 'flatline',
+        'detail': [f"all hours are {v:g} kWh" for v in extremes.loc[flatline, 'min']],
+        'refetch': 1,
+    }))
+
+    history = daily_total['value'].to_numpy(dtype=float)
+    median = np.median(history)
+    mad = np.median(np.abs(history - median))
+    if mad > 0:
+        total = days['value'].sum()
+        z = 0.6745 * (total - median) / mad
+        spike = z.abs() > spike_threshold
+        issues.append(pd.DataFrame({
+            'date': total.index[spike],
+            'issue': 'spike',
+            'detail': [f"{t:.2f} kWh, robust z-score {s:.1f}" for t, s in
+                       zip(total[spike], z[spike])],
+            'refetch': 0,
+        }))
+
+    issues = pd.concat(issues, ignore_index=True)
+    issues['date'] = pd.DatetimeIndex(issues['date']).strftime("%Y-%m-%d")
+    return issues[issue_columns]
+
+
+def scan_usage(row_id, start_date=None, end_date=None):
+    """
+    Scan hourly usage of a meter for data-quality issues, and replace the issues of the
+    scanned period in table "usage_issue". Days which have been fetched again keep the
+    mark, so they are not fetched again and again.
+    :param row_id: ROWID of the meter in table "meter"
+    :param start_date: str "%Y-%m-%d", default the earliest date.
+    :param end_date: str "%Y-%m-%d", default the latest date.
+    :return: Table of issues in the scanned period, see `find_issues`
+    """
+    start_date = start_date or "1996-01-01"
+    end_date = end_date or "9999-12-31"
+    c = sqlite3.connect(get_db_path())
+    exist_table_usage = c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='usage'"
+    ).fetchone()
+    if exist_table_usage is None:
+        c.close()
+        return pd.DataFrame(columns=issue_columns)
+    create_issue_table(c)
+    usage = pd.read_sql_query(
+        sql="select year, month, day, hour, value from usage where date(printf("
+            "'%04d-%02d-%02d', year, month, day)) between date(?) and date(?) "
+            "and meter_id = ?",
+        con=c,
+        params=[start_date, end_date, row_id]
+    )
+    daily_total = pd.read_sql_query(
+        sql="select year, month, day, sum(value) as value from usage where meter_id = ? "
+            "group by year, month, day",
+        con=c,
+        params=[row_id]
+    )
+    issues = find_issues(usage, daily_total)
+    refetched = pd.read_sql_query(
+        sql="select date, issue, refetched from usage_issue where meter_id = ? and "
+            "date between date(?) and date(?)",
+        con=c,
+        params=[row_id, start_date, end_date]
+    )
+    issues = issues.merge(refetched, on=['date', 'issue'], how='left')
+    issues['refetched'] = issues['refetched'].fillna(0).astype(int)
+    c.execute("delete from usage_issue where meter_id = ? and date between date(?) and "
+              "date(?)", (row_id, start_date, end_date))
+    c.executemany(
+        "insert into usage_issue (meter_id, date, issue, detail, refetch, refetched) "
+        "values (?, ?, ?, ?, ?, ?)",
+        [(row_id, *r) for r in issues[issue_columns + ['refetched']].itertuples(
+            index=False, name=None)]
+    )
+    c.commit()
+    c.close()
+    return issues[issue_columns]
+
+
+def scan_all_usage():
+    """
+    Scan all hourly usage of all meters for data-quality issues.
+    :return:
+    """
+    start = time.perf_counter()
+    meters = get_account_contract_list()
+    for row_id in meters['rowid']:
+        issues = scan_usage(int(row_id))
+        logging.info(f"Meter {row_id}: {issues.shape[0]} issues, "
+                     f"{int(issues['refetch'].sum())} days to fetch again.")
+    logging.info(f"Scanned {meters.shape[0]} meters in "
+                 f"{time.perf_counter() - start:.1f} seconds.")
+
+
+def get_usage_issues(start_date, end_date, row_id):
+    c = sqlite3.connect(get_db_path())
+    try:
+        issues = pd.read_sql_query(
+            sql="select date, issue, detail, refetch from usage_issue where "
+                "meter_id = ? and date between date(?) and date(?) order by date, issue",
+            con=c,
+            params=[row_id, start_date, end_date]
+        )
+    except pd.errors.DatabaseError:
+        issues = pd.DataFrame(columns=issue_columns)
+    c.close()
+    return issues
+
+
+def mark_refetched(row_id, date_):
+    """
+    Mark a day flagged by the scanner as fetched again.
+    :param row_id: ROWID of the meter in table "meter"
+    :param date_: The day
+    :return:
+    """
+    c = sqlite3.connect(get_db_path())
+    try:
+        c.execute("update usage_issue set refetched = 1 where meter_id = ? and date = ?",
+                  (row_id, pd.Timestamp(date_).strftime("%Y-%m-%d")))
+        c.commit()
+    except sqlite3.OperationalError:
+        pass
+    c.close()
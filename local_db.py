@@ -1,14 +1,34 @@
 import logging
 import sqlite3
+from contextvars import ContextVar
 
 import pandas as pd
 
-db_path = "contact_energy.db"
+# In server mode, each session sets the database file of its user.
+db_path = ContextVar("db_path", default="contact_energy.db")
+
+
+def get_db_path():
+    return db_path.get()
+
+
+def create_usage_index(c):
+    """
+    Create the index of hourly usage by meter and time, which is shared by all lookups of
+    table "usage".
+    :param c: sqlite3 connection
+    :return:
+    """
+    c.execute("create index if not exists usage_key on usage "
+              "(meter_id, year, month, day, hour)")
+    # superseded by "usage_key", created by previous versions of this program
+    c.execute("drop index if exists usage_meter_id")
+    c.commit()
 
 
 def get_account_contract_row_id(account_number, contract_id):
     meter = None
-    c = sqlite3.connect(db_path)
+    c = sqlite3.connect(get_db_path())
     try:
         meter = pd.read_sql_query(
             sql="select ROWID from meter where account_number = ? and contract_id = ?",
@@ -16,7 +36,7 @@ def get_account_contract_row_id(account_number, contract_id):
             params=[account_number, contract_id],
         )
     except pd.errors.DatabaseError:
-        logging.info(f"Create a new database \"{db_path}\".")
+        logging.info(f"Create a new database \"{get_db_path()}\".")
     if (meter is None) or meter.shape[0] == 0:
         meter = pd.DataFrame([
             {"account_number": account_number, "contract_id": contract_id}
@@ -34,7 +54,7 @@ def get_account_contract_row_id(account_number, contract_id):
 
 
 def get_account_contract_list():
-    c = sqlite3.connect(db_path)
+    c = sqlite3.connect(get_db_path())
     try:
         meter = pd.read_sql_query(
             sql='select ROWID, * from meter',
@@ -48,7 +68,7 @@ def get_account_contract_list():
 
 def get_missing_dates_in_usage(start_date, end_date, row_id):
     all_dates = pd.date_range(start=start_date, end=end_date, freq='1d')
-    c = sqlite3.connect(db_path)
+    c = sqlite3.connect(get_db_path())
     try:
         exist_dates = pd.read_sql_query(
             sql="select distinct year, month, day from usage where date(printf("
@@ -59,15 +79,27 @@ def get_missing_dates_in_usage(start_date, end_date, row_id):
         )
     except pd.errors.DatabaseError:
         return all_dates
-    c.close()
     exist_dates = pd.DatetimeIndex(pd.to_datetime(exist_dates))
     missing_dates = all_dates.difference(exist_dates)
+    # days flagged by the data-quality scanner, see `contact_energy.quality`
+    try:
+        refetch_dates = pd.read_sql_query(
+            sql="select distinct date from usage_issue where meter_id = ? and "
+                "refetch = 1 and refetched = 0 and date between date(?) and date(?)",
+            con=c,
+            params=[row_id, start_date, end_date]
+        )
+        missing_dates = missing_dates.union(
+            pd.DatetimeIndex(pd.to_datetime(refetch_dates['date'])))
+    except pd.errors.DatabaseError:
+        pass
+    c.close()
     return missing_dates
 
 
 def get_usage(start_date, end_date, row_id):
     try:
-        c = sqlite3.connect(db_path)
+        c = sqlite3.connect(get_db_path())
         usage = pd.read_sql_query(
             sql="select * from usage where date(printf('%04d-%02d-%02d', year, month, "
                 "day)) between date(?) and date(?) and meter_id = ?",
@@ -93,6 +125,24 @@ def save_usage(usage, row_id):
     usage = usage[['year', 'month', 'day', 'hour', 'value']]
     usage['value'] = usage['value'].astype(float)
     usage.insert(loc=0, column='meter_id', value=row_id)
-    c = sqlite3.connect(db_path)
+    c = sqlite3.connect(get_db_path())
+    # Days which are fetched again replace the stored hours.
+    exist_table_usage = c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='usage'"
+    ).fetchone()
+    if exist_table_usage is not None:
+        replaced = c.executemany(
+            "delete from usage where meter_id = ? and year = ? and month = ? and day = ?",
+            usage[['meter_id', 'year', 'month', 'day']].drop_duplicates().itertuples(
+                index=False, name=None)
+        ).rowcount
+        # New rows may reuse the rowids of deleted rows, so the seasonal profile, see
+        # `contact_energy.forecast`, is fitted again from scratch.
+        if replaced > 0:
+            try:
+                c.execute("delete from profile_state where meter_id = ?", (row_id,))
+            except sqlite3.OperationalError:
+                pass
     usage.to_sql(name="usage", con=c, index=False, if_exists="append")
+    create_usage_index(c)
     c.close()
@@ -1,17 +1,32 @@
+import argparse
+import getpass
+import json
+import os
+import re
 import socket
 import sys
+import threading
+import time
 import webbrowser
 from datetime import datetime, timedelta
+from random import uniform
 
 import pywebio
-from flask import Flask
+import waitress
+from flask import Flask, Response, request, session
 from pyecharts.charts import Bar, HeatMap
 from pyecharts.options import LabelOpts, VisualMapOpts
 from pywebio.platform.flask import webio_view
+from werkzeug.security import check_password_hash, generate_password_hash
 
 from contact_energy.aws_lambda import ContactEnergyUsage
+from contact_energy.forecast import get_profile, project_annual_usage
+from contact_energy.quality import (get_usage_issues, mark_refetched, scan_all_usage,
+                                    scan_usage)
 from local_db import *
 from contact_energy.pricing import *
+from parquet_io import export_parquet, import_parquet
+from worker_pool import run_in_pool, start_worker_pool
 
 app = Flask(__name__)
 logging.basicConfig(
@@ -19,6 +34,52 @@ logging.basicConfig(
     stream=sys.stdout,
     format="%(levelname).1s %(message)s",
 )
+# Server mode only. In desktop mode, all sessions share "contact_energy.db".
+server_users = None
+server_data_dir = None
+# Database files which are migrated by this process, see `use_user_database`.
+migrated_db_paths = set()
+migrate_lock = threading.Lock()
+
+
+def require_login():
+    """
+    In server mode, verify the password once per browser, then trust the signed session
+    cookie, because password hashing is slow and pywebio polls every second per tab.
+    The verified username is passed to pywebio sessions as "REMOTE_USER".
+    :return:
+    """
+    if server_users is None:
+        return
+    username = session.get("username")
+    if username not in server_users:
+        auth = request.authorization
+        if (auth is None or auth.username not in server_users or
+                not check_password_hash(server_users[auth.username], auth.password)):
+            return Response("Login required.", status=401,
+                            headers={"WWW-Authenticate": 'Basic realm="Contact usage"'})
+        username = auth.username
+        session["username"] = username
+    request.environ["REMOTE_USER"] = username
+
+
+def use_user_database():
+    """
+    In server mode, let the current session read and write the database file of the
+    logged-in user.
+    :return:
+    """
+    if server_users is None:
+        return
+    username = pywebio.session.info.request.environ["REMOTE_USER"]
+    user_db_path = os.path.join(server_data_dir, f"{username}.db")
+    db_path.set(user_db_path)
+    # A database file may be copied from previous versions while the server is running.
+    with migrate_lock:
+        if user_db_path not in migrated_db_paths:
+            migrate_price_table()
+            migrated_db_paths.add(user_db_path)
+
 
 def get_unit_price_form(unit_price: dict):
     form6 = pywebio.input.input_group("Unit price (without GST)", [
@@ -147,7 +208,15 @@ def validate_start_date(date_str):
         return "The date cannot be earlier than " + earliest_date.strftime("%Y-%m-%d")
 
 
+def fetch_usage(api, account_number, contract_id, date_, row_id):
+    usage = api.get_usage(account_number, contract_id, date_)
+    if usage is not None:
+        save_usage(usage, row_id)
+        mark_refetched(row_id, date_)
+
+
 def index():
+    use_user_database()
     pywebio.output.put_markdown(
         "# Contact usage\n"
         "Compare electricity prices between Contact Energy electricity plans\n"
@@ -239,29 +308,36 @@ def index():
     pywebio.output.put_progressbar(name="get_usage", init=0)
     progress_total = len(missing_dates)
     for i, date_ in enumerate(missing_dates):
-        usage = api.get_usage(form2['account_number'], form3['contract_id'], date_)
-        if usage is not None:
-            save_usage(usage, row_id)
+        run_in_pool(fetch_usage, api, form2['account_number'], form3['contract_id'],
+                    date_, row_id)
+        # Pace requests to Contact Energy on the session thread, so the sleep does not
+        # hold a worker of the shared pool.
+        time.sleep(round(uniform(0.7, 1.3), 2))
         progress_current = (i + 1) / progress_total
         pywebio.output.set_progressbar(name="get_usage", value=progress_current)
+    run_in_pool(scan_usage, row_id, form3['start_date'], form3['end_date'])
     pywebio.output.put_text(
         "The program has finished updating electricity usage data."
     )
 
     # read usage from the database (after updated)
-    usage = get_usage(form3['start_date'], form3['end_date'], row_id)
-    unit_price_ = get_unit_price(row_id)
+    usage = run_in_pool(get_usage, form3['start_date'], form3['end_date'], row_id)
+    unit_price_ = get_unit_price_versions(row_id)
+    issues = get_usage_issues(form3['start_date'], form3['end_date'], row_id)
 
     # analyze electricity price
     draw_charts([{
+        'row_id': row_id,
         'account_number': form2['account_number'],
         'contract_id': form3['contract_id'],
         'usage': usage,
         'unit_price': unit_price_,
+        'issues': issues,
     }])
 
 
 def view_unit_price():
+    use_user_database()
     pywebio.output.put_link(name="Back", url="/")
     all_meters = get_account_contract_list()
     all_meters_options = [
@@ -276,6 +352,18 @@ def view_unit_price():
             name="row_id",
             required=True
         ),
+        pywebio.input.input(
+            label="Effective date",
+            type=pywebio.input.DATE,
+            value=datetime.now().strftime("%Y-%m-%d"),
+            name="effective_date",
+            required=True,
+            help_text="The unit prices apply from this date until the effective date of "
+                      "the next unit prices, so historical usage is priced at the rates "
+                      "then in force. The earliest unit prices also apply before their "
+                      "effective date.",
+            validate=validate_start_date,
+        ),
         pywebio.input.checkbox(
             name="copy_from_another_meter",
             type=pywebio.input.CHECKBOX,
@@ -285,6 +373,7 @@ def view_unit_price():
         ),
     ])
     row_id = form1['row_id']
+    effective_date = form1['effective_date']
 
     if 'yes' in form1['copy_from_another_meter']:
         form4 = pywebio.input.input_group("Select the template meter", [
@@ -296,17 +385,18 @@ def view_unit_price():
             ),
         ])
         reference_row_id = form4['row_id']
-        reference_prices = get_unit_price(reference_row_id)
-        save_unit_price(row_id, **reference_prices)
+        reference_prices = get_unit_price(reference_row_id, effective_date)
+        save_unit_price(row_id, effective_date, **reference_prices)
 
     # No guarantee that data in the database is complete, so even this function autofill
     # the existed unit price, default unit price is still needed.
-    existed_unit_price = get_unit_price(row_id)
+    existed_unit_price = get_unit_price(row_id, effective_date)
     existed_unit_price = {k: None if np.isnan(v) else v
                           for k, v in existed_unit_price.items()}
     form2 = get_unit_price_form(existed_unit_price)
-    save_unit_price(row_id, **form2)
-    pywebio.output.put_text("Unit prices of the current meter are saved to the database.")
+    save_unit_price(row_id, effective_date, **form2)
+    pywebio.output.put_text(f"Unit prices of the current meter effective from "
+                            f"{effective_date} are saved to the database.")
 
 
 def checkbox_non_empty(selected_options):
@@ -318,10 +408,12 @@ def draw_charts(meters: list[dict]):
     """
     Draw statistics
     :param meters: list [ dict ]
+        row_id: ROWID of the meter in table "meter"
         account_number: str
         contract_id: str
         usage: returned value of `get_usage`
-        unit_price: returned value of `get_unit_price
+        unit_price: returned value of `get_unit_price_versions`
+        issues: returned value of `get_usage_issues`
     :return:
     """
     # Figure 1: bar
@@ -329,7 +421,7 @@ def draw_charts(meters: list[dict]):
     for i, meter in enumerate(meters):
         account_number = meter['account_number']
         contract_id = meter['contract_id']
-        total_price = get_total_price(meter['usage'], meter['unit_price'])
+        total_price = run_in_pool(get_total_price, meter['usage'], meter['unit_price'])
         if i == 0:
             common_plans = set(total_price.keys())
         else:
@@ -352,7 +444,63 @@ def draw_charts(meters: list[dict]):
     )
     pywebio.output.put_html(fig1.render_notebook())
 
-    # Figure 2: heatmap
+    # Figure 2: bar, projected to 12 months
+    fig2 = Bar()
+    observed_months = []
+    annual_prices = []
+    for meter in meters:
+        profile = run_in_pool(get_profile, meter['row_id'])
+        observed_months.append(profile['month'].nunique())
+        annual_usage = run_in_pool(project_annual_usage, profile)
+        # the next 12 months are priced at the current rates
+        annual_prices.append(run_in_pool(get_total_price, annual_usage,
+                                         get_unit_price(meter['row_id'])))
+    annual_plans = sorted(set.intersection(*[set(p.keys()) for p in annual_prices]))
+    fig2.add_xaxis(annual_plans)
+    for meter, annual_price in zip(meters, annual_prices):
+        account_number = meter['account_number']
+        contract_id = meter['contract_id']
+        fig2.add_yaxis(
+            f"Account number: {account_number}\nContract ID: {contract_id}",
+            [annual_price[plan] for plan in annual_plans]
+        )
+    pywebio.output.put_markdown(
+        "# Projected annual electricity cost (including GST)\n"
+        "\n"
+        "The electricity usage of the next 12 months is extrapolated from the average "
+        "usage of each weekday, intraday 1-hour interval, and month in all stored "
+        "history of the meter. Months without history use the average of all observed "
+        "months, so the projection is more reliable when more months are observed.\n"
+        "\n"
+        f"Observed months of year (per meter): {', '.join(map(str, observed_months))}\n"
+        "\n"
+        "Unit: NZD"
+    )
+    pywebio.output.put_html(fig2.render_notebook())
+
+    # Table: data quality
+    pywebio.output.put_markdown(
+        "# Data quality\n"
+        "\n"
+        "Days with missing, duplicated, or flat hourly usage are fetched again in the "
+        "next update, and are excluded from the temporal electricity usage. Daily usage "
+        "spikes and hours which do not exist in local time (DST) are only reported."
+    )
+    for meter in meters:
+        account_number = meter['account_number']
+        contract_id = meter['contract_id']
+        pywebio.output.put_text(
+            f"Account number: {account_number}, Contract ID: {contract_id}")
+        issues = meter['issues']
+        if issues.shape[0] == 0:
+            pywebio.output.put_text("No issue is found.")
+            continue
+        pywebio.output.put_table(
+            issues[['date', 'issue', 'detail']].values.tolist(),
+            header=['Date', 'Issue', 'Detail'],
+        )
+
+    # Figure 3: heatmap
     pywebio.output.put_markdown(
         "# Temporal electricity usage\n"
         "\n"
@@ -365,28 +513,31 @@ def draw_charts(meters: list[dict]):
     hour_intervals = [f'{i}:00-{i + 1}:00' for i in range(23)]
     hour_intervals.append("23:00-0:00")
     for meter in meters:
-        fig2 = HeatMap()
-        fig2.add_xaxis(hour_intervals)
+        fig3 = HeatMap()
+        fig3.add_xaxis(hour_intervals)
         usage = meter['usage']
         usage['date'] = pd.to_datetime(usage[['year', 'month', 'day']])
+        refetch_dates = meter['issues'].loc[meter['issues']['refetch'] == 1, 'date']
+        usage = usage[~usage['date'].dt.strftime("%Y-%m-%d").isin(refetch_dates)].copy()
         usage['weekday'] = usage['date'].dt.weekday
         pivot = usage[['hour', 'weekday', 'value']].groupby(by=['hour', 'weekday']).mean()
         pivot.reset_index(inplace=True)
         account_number = meter['account_number']
         contract_id = meter['contract_id']
-        fig2.add_yaxis(
+        fig3.add_yaxis(
             f"Account number: {account_number}\nContract ID: {contract_id}",
             weekdays,
             pivot.round(2).values.tolist(),
             label_opts=LabelOpts(is_show=True, position="inside"),
         )
-        fig2.set_global_opts(
+        fig3.set_global_opts(
             visualmap_opts=VisualMapOpts(min_=0, max_=pivot['value'].max())
         )
-        pywebio.output.put_html(fig2.render_notebook())
+        pywebio.output.put_html(fig3.render_notebook())
 
 
 def analyze():
+    use_user_database()
     pywebio.output.put_link(name="Back", url="/")
     all_meters = get_account_contract_list()
     all_meters_options = [
@@ -427,20 +578,24 @@ def analyze():
     meters = []
     for row_id in rows_id:
         # total electricity price
-        usage = get_usage(form1['start_date'], form1['end_date'], row_id)
-        unit_price_ = get_unit_price(row_id)
+        usage = run_in_pool(get_usage, form1['start_date'], form1['end_date'], row_id)
+        unit_price_ = get_unit_price_versions(row_id)
+        issues = get_usage_issues(form1['start_date'], form1['end_date'], row_id)
         account_number = all_meters.loc[
             all_meters['rowid'] == row_id, 'account_number'][0]
         contract_id = all_meters.loc[all_meters['rowid'] == row_id, 'contract_id'][0]
         meters.append({
+            'row_id': row_id,
             'account_number': account_number,
             'contract_id': contract_id,
             'usage': usage,
             'unit_price': unit_price_,
+            'issues': issues,
         })
     draw_charts(meters)
 
 
+app.before_request(require_login)
 app.add_url_rule(rule='/', endpoint='index', view_func=webio_view(index),
                  methods=['GET', 'POST', 'OPTIONS'])
 app.add_url_rule(rule='/unit_price', endpoint='unit_price',
@@ -469,7 +624,105 @@ def find_available_port(start_port: int, tries: int = 100):
                     f"{start_port + tries}.")
 
 
+def add_user(data_dir: str, username: str):
+    """
+    Add a user of server mode, or reset the password of an existed user.
+    :param data_dir: The folder of users' database files and "users.json".
+    :param username: Letters, digits, "_", "-", and "." only, because it is also the
+        name of the user's database file.
+    :return:
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_.-]+", username):
+        raise Exception(f"Invalid username \"{username}\". Only letters, digits, \"_\", "
+                        f"\"-\", and \".\" are allowed.")
+    os.makedirs(data_dir, exist_ok=True)
+    users_path = os.path.join(data_dir, "users.json")
+    users = {}
+    if os.path.exists(users_path):
+        with open(users_path) as f:
+            users = json.load(f)
+    users[username] = generate_password_hash(getpass.getpass(f"Password of {username}: "))
+    with open(users_path, "w") as f:
+        json.dump(users, f, indent=4)
+    logging.info(f"User \"{username}\" is saved to \"{users_path}\".")
+
+
+def serve(host: str, port: int, data_dir: str, threads: int, workers: int,
+          queue: int):
+    """
+    Start the production server for multiple users.
+    Each user logs in with HTTP basic authentication and has their own database file
+    "{data_dir}/{username}.db". Long fetches and analyses of all users run in a shared
+    worker pool.
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    :param data_dir: The folder of users' database files and "users.json".
+    :param threads: Number of threads which handle HTTP requests.
+    :param workers: Number of workers in the shared worker pool.
+    :param queue: Number of jobs that wait for a free worker.
+    :return:
+    """
+    global server_users, server_data_dir
+    users_path = os.path.join(data_dir, "users.json")
+    if not os.path.exists(users_path):
+        raise Exception(f"\"{users_path}\" does not exist. Please add users by "
+                        f"\"python main.py --data-dir {data_dir} --add-user USERNAME\".")
+    with open(users_path) as f:
+        server_users = json.load(f)
+    server_data_dir = data_dir
+    # Session cookies are valid until the server restarts.
+    app.secret_key = os.urandom(32)
+    start_worker_pool(max_workers=workers, max_queued=queue)
+    # pywebio keeps sessions in the process memory, so the server runs in one process.
+    waitress.serve(app, host=host, port=port, threads=threads)
+
+
 if __name__ == '__main__':
-    port = find_available_port(5000)
-    webbrowser.open_new_tab(f'http://localhost:{port}')
-    app.run(port=port)
+    parser = argparse.ArgumentParser(description="Compare electricity prices between "
+                                                 "Contact Energy electricity plans")
+    parser.add_argument("--server", action="store_true",
+                        help="Start the server mode for multiple users.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Server mode: the address to listen on.")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Server mode: the port to listen on.")
+    parser.add_argument("--data-dir", default="users",
+                        help="Server mode: the folder of users' database files.")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="Server mode: number of threads handling HTTP requests.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Server mode: number of workers fetching and analyzing "
+                             "data.")
+    parser.add_argument("--queue", type=int, default=64,
+                        help="Server mode: number of jobs waiting for a free worker.")
+    parser.add_argument("--add-user", metavar="USERNAME",
+                        help="Add a user of server mode, or reset the password.")
+    parser.add_argument("--export", metavar="FOLDER",
+                        help="Export usage, meters and unit prices to Parquet files.")
+    parser.add_argument("--import", metavar="FOLDER", dest="import_",
+                        help="Merge usage, meters and unit prices from Parquet files "
+                             "exported by \"--export\".")
+    parser.add_argument("--scan", action="store_true",
+                        help="Scan all stored usage for data-quality issues.")
+    parser.add_argument("--database", default=db_path.get(),
+                        help="The database file to export, import, or scan.")
+    args = parser.parse_args()
+    if args.add_user:
+        add_user(args.data_dir, args.add_user)
+    elif args.export or args.import_ or args.scan:
+        db_path.set(args.database)
+        migrate_price_table()
+        if args.export:
+            export_parquet(args.export)
+        if args.import_:
+            import_parquet(args.import_)
+        if args.scan:
+            scan_all_usage()
+    elif args.server:
+        serve(args.host, args.port, args.data_dir, args.threads, args.workers,
+              args.queue)
+    else:
+        migrate_price_table()
+        port = find_available_port(5000)
+        webbrowser.open_new_tab(f'http://localhost:{port}')
+        app.run(port=port)
@@ -0,0 +1,180 @@
+import logging
+import os
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from contact_energy.pricing import create_price_table, earliest_effective_date
+from local_db import (create_usage_index, get_account_contract_row_id,
+                      get_db_path)
+
+batch_size = 100_000
+meter_schema = pa.schema([
+    ("meter_id", pa.int64()),
+    ("account_number", pa.string()),
+    ("contract_id", pa.string()),
+])
+usage_schema = pa.schema([
+    ("meter_id", pa.int64()),
+    ("year", pa.int32()),
+    ("month", pa.int32()),
+    ("day", pa.int32()),
+    ("hour", pa.int32()),
+    ("value", pa.float64()),
+])
+price_schema = pa.schema([
+    ("meter_id", pa.int64()),
+    ("name", pa.string()),
+    ("price", pa.float64()),
+    ("effective_date", pa.string()),
+])
+
+
+def exist_table(c, name):
+    return c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)
+    ).fetchone() is not None
+
+
+def read_batches(c, sql, schema):
+    """
+    Read the result of a query in batches, so the memory usage is bounded.
+    :param c: sqlite3 connection
+    :param sql: Query whose columns are in the same order as the schema.
+    :param schema: pyarrow schema of the result
+    :return: generator of pyarrow record batches
+    """
+    cursor = c.execute(sql)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        yield pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        )
+
+
+def write_batches(batches, schema, path, partitioning):
+    ds.write_dataset(
+        batches,
+        base_dir=path,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning,
+        partitioning_flavor="hive" if partitioning else None,
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+    )
+
+
+def export_parquet(out_dir):
+    """
+    Export tables "meter", "usage" and "price" to Parquet datasets. "usage" is
+    partitioned by meter and year, "price" is partitioned by meter.
+    :param out_dir: The folder to export to. Partitions in this folder that are
+        exported again are overwritten.
+    :return:
+    """
+    # pyarrow reads the batches in its own thread.
+    c = sqlite3.connect(get_db_path(), check_same_thread=False)
+    if not exist_table(c, "meter"):
+        c.close()
+        logging.warning("The table \"meter\" does not exist, so there is no data to "
+                        "export.")
+        return
+    write_batches(
+        read_batches(c, "select ROWID, account_number, contract_id from meter",
+                     meter_schema),
+        meter_schema, os.path.join(out_dir, "meter"), None,
+    )
+    if exist_table(c, "usage"):
+        write_batches(
+            read_batches(c, "select meter_id, year, month, day, hour, value from usage "
+                            "order by meter_id, year, month, day, hour", usage_schema),
+            usage_schema, os.path.join(out_dir, "usage"), ["meter_id", "year"],
+        )
+    if exist_table(c, "price"):
+        create_price_table(c)
+        write_batches(
+            read_batches(c, "select meter_id, name, price, effective_date from price "
+                            "order by meter_id", price_schema),
+            price_schema, os.path.join(out_dir, "price"), ["meter_id"],
+        )
+    c.close()
+    logging.info(f"The database \"{get_db_path()}\" is exported to \"{out_dir}\".")
+
+
+def import_parquet(in_dir):
+    """
+    Merge Parquet datasets exported by `export_parquet` into the database. Meters are
+    matched by account number and contract ID. Days of hourly usage and unit prices that
+    already exist in the database are kept, so importing the same data again changes
+    nothing.
+    :param in_dir: The folder to import from.
+    :return:
+    """
+    meter = ds.dataset(os.path.join(in_dir, "meter"), format="parquet").to_table()
+    meter_id_map = {
+        meter_id: get_account_contract_row_id(account_number, contract_id)
+        for meter_id, account_number, contract_id in zip(
+            meter.column("meter_id").to_pylist(),
+            meter.column("account_number").to_pylist(),
+            meter.column("contract_id").to_pylist(),
+        )
+    }
+
+    c = sqlite3.connect(get_db_path())
+    usage_path = os.path.join(in_dir, "usage")
+    if os.path.isdir(usage_path):
+        c.execute("create table if not exists usage (meter_id INTEGER, year INTEGER, "
+                  "month INTEGER, day INTEGER, hour INTEGER, value REAL)")
+        create_usage_index(c)
+        c.execute("create temp table usage_import (meter_id INTEGER, year INTEGER, "
+                  "month INTEGER, day INTEGER, hour INTEGER, value REAL)")
+        usage = ds.dataset(usage_path, schema=usage_schema, format="parquet",
+                           partitioning=ds.partitioning(
+                               pa.schema([usage_schema.field("meter_id"),
+                                          usage_schema.field("year")]), flavor="hive"))
+        for batch in usage.to_batches(columns=usage_schema.names, batch_size=batch_size):
+            c.executemany(
+                "insert into usage_import values (?, ?, ?, ?, ?, ?)",
+                zip([meter_id_map[m] for m in batch.column("meter_id").to_pylist()],
+                    *[batch.column(name).to_pylist() for name in usage_schema.names[1:]])
+            )
+        # A day may span two batches, so all batches are staged before merging. Days are
+        # merged as a whole like `save_usage`, which keeps the repeated hour of a DST
+        # fall-back day.
+        c.execute(
+            "insert into usage select meter_id, year, month, day, hour, value "
+            "from usage_import i where not exists (select 1 from usage u where "
+            "u.meter_id = i.meter_id and u.year = i.year and u.month = i.month and "
+            "u.day = i.day)"
+        )
+        c.execute("drop table usage_import")
+        c.commit()
+
+    price_path = os.path.join(in_dir, "price")
+    if os.path.isdir(price_path):
+        create_price_table(c)
+        price = ds.dataset(price_path, schema=price_schema, format="parquet",
+                           partitioning=ds.partitioning(
+                               pa.schema([price_schema.field("meter_id")]), flavor="hive"))
+        for batch in price.to_batches(columns=price_schema.names, batch_size=batch_size):
+            # Parquet files exported before unit prices are versioned have no
+            # effective date.
+            c.executemany(
+                "insert into price (meter_id, name, price, effective_date) "
+                "select ?1, ?2, ?3, coalesce(?4, ?5) where not exists (select 1 from price "
+                "where meter_id = ?1 and name = ?2 and effective_date = coalesce(?4, ?5))",
+                zip([meter_id_map[m] for m in batch.column("meter_id").to_pylist()],
+                    batch.column("name").to_pylist(),
+                    batch.column("price").to_pylist(),
+                    batch.column("effective_date").to_pylist(),
+                    [earliest_effective_date] * batch.num_rows)
+            )
+            c.commit()
+    c.close()
+    logging.info(f"\"{in_dir}\" is imported to the database \"{get_db_path()}\".")
@@ -0,0 +1,39 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+pool = None
+pool_slots = None
+
+
+def start_worker_pool(max_workers: int, max_queued: int):
+    """
+    Start the worker pool shared by all sessions.
+    :param max_workers: Number of jobs that run at the same time.
+    :param max_queued: Number of jobs that wait for a free worker. When the queue is full,
+        the session that submits a job waits until there is a free slot.
+    :return:
+    """
+    global pool, pool_slots
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker")
+    pool_slots = threading.BoundedSemaphore(max_workers + max_queued)
+    logging.info(f"Start a worker pool with {max_workers} workers and {max_queued} "
+                 f"queued jobs.")
+
+
+def run_in_pool(fn, *args, **kwargs):
+    """
+    Run a job in the shared worker pool, and wait for its result.
+    The job runs in a copy of the caller's context, so it reads and writes the caller's
+    database. Sessions submit one job at a time, so long jobs of one user are split into
+    small jobs and interleave with other users' jobs. If the worker pool is not started
+    (desktop mode), the job runs in the caller's thread.
+    :param fn: The job.
+    :return: returned value of the job
+    """
+    if pool is None:
+        return fn(*args, **kwargs)
+    ctx = contextvars.copy_context()
+    with pool_slots:
+        return pool.submit(ctx.run, fn, *args, **kwargs).result()